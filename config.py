@@ -1,27 +1,82 @@
 # config.py (Corrected for Railway and other hosts)
 import os
 
-# --- Discord Bot Configuration ---
-DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
+def _flag(value: str) -> bool:
+    """Parse a boolean environment variable such as 'true', '0' or 'off'."""
+    value = value.strip().lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    if value in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError(value)
 
-# --- Twitch API Configuration ---
-TWITCH_CLIENT_ID = os.getenv('TWITCH_CLIENT_ID')
-TWITCH_CLIENT_SECRET = os.getenv('TWITCH_CLIENT_SECRET')
+# Environment-backed settings are resolved on first access through the module
+# __getattr__ below (PEP 562) and then cached in the module namespace.
+# Maps setting name -> (environment variable, default, converter).
+_ENV = {
+    # --- Discord Bot Configuration ---
+    'DISCORD_TOKEN': ('DISCORD_TOKEN', None, None),
 
-# --- YouTube API Configuration ---
-YOUTUBE_API_KEY = os.getenv('YOUTUBE_API_KEY')
+    # --- Twitch API Configuration ---
+    'TWITCH_CLIENT_ID': ('TWITCH_CLIENT_ID', None, None),
+    'TWITCH_CLIENT_SECRET': ('TWITCH_CLIENT_SECRET', None, None),
 
-# --- Webhook Security ---
-WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+    # --- YouTube API Configuration ---
+    'YOUTUBE_API_KEY': ('YOUTUBE_API_KEY', None, None),
 
-# --- Server Configuration ---
-# Use the WEBHOOK_BASE_URL environment variable you will set in the hosting platform's secrets.
-WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL')
+    # --- Webhook Security ---
+    'WEBHOOK_SECRET': ('WEBHOOK_SECRET', None, None),
+
+    # --- Server Configuration ---
+    # Use the WEBHOOK_BASE_URL environment variable you will set in the hosting platform's secrets.
+    'WEBHOOK_BASE_URL': ('WEBHOOK_BASE_URL', None, None),
+    # Use the PORT environment variable provided by the host.
+    'FLASK_PORT': ('PORT', '8080', int),
+
+    # --- Notification Options ---
+    # Look up the stream title and category for Twitch notifications (one extra Helix call per go-live).
+    'INCLUDE_STREAM_DETAILS': ('INCLUDE_STREAM_DETAILS', 'true', _flag),
+}
+
+# Settings the bot cannot run without; checked by validate() at startup.
+REQUIRED = (
+    'DISCORD_TOKEN',
+    'TWITCH_CLIENT_ID',
+    'TWITCH_CLIENT_SECRET',
+    'YOUTUBE_API_KEY',
+    'WEBHOOK_SECRET',
+    'WEBHOOK_BASE_URL',
+)
+
+def __getattr__(name):
+    if name not in _ENV:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    env_var, default, convert = _ENV[name]
+    value = os.environ.get(env_var, default)
+    if convert is not None and value is not None:
+        try:
+            value = convert(value)
+        except ValueError:
+            raise SystemExit(f"Invalid value for environment variable {env_var}: {value!r}")
+    globals()[name] = value
+    return value
+
+def validate() -> None:
+    """Exit with a clear message if any required setting is missing or malformed."""
+    missing = [_ENV[name][0] for name in REQUIRED if not os.environ.get(_ENV[name][0])]
+    if missing:
+        raise SystemExit(f"Missing required environment variables: {', '.join(missing)}")
+    for name, (_, _, convert) in _ENV.items():
+        if convert is not None:
+            __getattr__(name)
 
-# Use the PORT environment variable provided by the host.
-FLASK_PORT = int(os.getenv('PORT', 8080))
 FLASK_HOST = '0.0.0.0'
 
+# --- HTTP Timeouts: (connect, read) in seconds ---
+HTTP_TIMEOUT = (2, 5)
+# Kept short so a slow Helix lookup can't hold up a Twitch notification
+STREAM_DETAILS_TIMEOUT = (1.0, 2.0)
+
 # --- API Endpoints (These are correct) ---
 TWITCH_TOKEN_URL = 'https://id.twitch.tv/oauth2/token'
 TWITCH_USERS_URL = 'https://api.twitch.tv/helix/users'
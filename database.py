@@ -1,77 +1,360 @@
 # database.py
 import json
+import mmap
 import os
-from typing import Dict, Optional, List
+import queue
+import shutil
+import threading
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass, fields, replace
+from typing import Any, Dict, Iterator, Optional, List, Set, Tuple
+
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib json module if orjson is unavailable
+    orjson = None
+
+def json_loads(raw: bytes) -> Any:
+    """Parse JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def json_dumps(data: Any, newline: bool = False) -> bytes:
+    """Serialize data (dataclasses included) to compact JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE if newline else None)
+    text = json.dumps(data, separators=(',', ':'), default=asdict)
+    return (text + '\n' if newline else text).encode('utf-8')
+
+@dataclass(frozen=True, slots=True)
+class Subscription:
+    """A single stream subscription."""
+    platform: str
+    guild_id: int
+    channel_id: int
+    name: str
+    subscription_id: Optional[str] = None
+    custom_message: Optional[str] = None
+    # Pre-rendered notification URLs, fixed for the lifetime of the subscription
+    thumbnail_url: Optional[str] = None
+    stream_url: Optional[str] = None
+    # Unix time at which the YouTube hub lease runs out; None if unknown
+    lease_expiry: Optional[float] = None
+
+_SUBSCRIPTION_FIELDS = frozenset(field.name for field in fields(Subscription))
+
+def _subscription_from_record(record: Dict) -> Subscription:
+    """Build a Subscription from a stored record, ignoring keys this version doesn't know."""
+    return Subscription(**{key: value for key, value in record.items() if key in _SUBSCRIPTION_FIELDS})
 
 class StreamDatabase:
-    """Simple file-based database for storing stream subscriptions."""
+    """Simple file-based database for storing stream subscriptions.
+    
+    The full table lives in ``db_file`` as a JSON snapshot. Mutations are
+    applied to ``self.data`` immediately and queued for a background writer
+    thread, which appends them to ``<db_file>.log`` as one JSON line each and
+    folds the log back into the snapshot once it grows large enough. Call
+    ``flush()`` before exiting to wait for pending writes.
+    """
+    
+    # Rough size of one logged record, used to decide when to compact.
+    RECORD_SIZE_ESTIMATE = 256
+    # Never compact a log smaller than this, however small the table is.
+    MIN_COMPACT_BYTES = 64 * 1024
+    # Mutations queued within this window of each other are written in one batch.
+    WRITE_COALESCE_DELAY = 0.05
+    # Mutators block once this many records are waiting for the writer thread.
+    WRITE_QUEUE_SIZE = 10000
+    # Snapshots at least this large are parsed straight from a read-only memory map.
+    MMAP_MIN_BYTES = 64 * 1024
     
     def __init__(self, db_file: str = 'streams.json'):
         self.db_file = db_file
+        self.log_file = db_file + '.log'
+        # Set if a snapshot that failed to load could not be moved aside; it must never be overwritten.
+        self._compaction_disabled = False
         self.data = self._load_data()
+        self._replay_log()
+        self._by_guild: Dict[int, Set[str]] = defaultdict(set)
+        self._by_platform: Dict[str, Set[str]] = defaultdict(set)
+        self._by_name: Dict[Tuple[int, str, str], str] = {}
+        self._by_lower_id: Dict[str, str] = {}
+        for streamer_id, sub in self.data.items():
+            self._index(streamer_id, sub)
+        self._log = open(self.log_file, 'ab', buffering=0)
+        # Guards self.data and the indexes. Held for in-memory work only; disk I/O
+        # happens on the writer thread, which never takes it.
+        self._lock = threading.RLock()
+        self._log_lock = threading.Lock()
+        self._write_q: queue.Queue = queue.Queue(maxsize=self.WRITE_QUEUE_SIZE)
+        self._writer = threading.Thread(target=self._writer_loop, name='StreamDatabase-writer', daemon=True)
+        self._writer.start()
     
-    def _load_data(self) -> Dict:
-        """Load data from JSON file or create empty structure."""
-        if os.path.exists(self.db_file):
+    def _load_data(self) -> Dict[str, Subscription]:
+        """Load data from JSON file or create empty structure.
+        
+        Malformed records are skipped one by one. Whenever anything is dropped, the
+        snapshot is kept under another name first, so compaction never destroys it.
+        """
+        try:
+            with open(self.db_file, 'rb') as f:
+                if orjson is None or os.fstat(f.fileno()).st_size < self.MMAP_MIN_BYTES:
+                    raw = json_loads(f.read())
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                        raw = orjson.loads(view)
+            if not isinstance(raw, dict):
+                raise ValueError("snapshot is not a JSON object")
+        except FileNotFoundError:
+            return {}
+        except (ValueError, OSError) as e:
+            print(f"Error loading database: {e}")
+            self._set_aside_snapshot(move=True)
+            return {}
+        
+        data = {}
+        for streamer_id, record in raw.items():
             try:
-                with open(self.db_file, 'r') as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, IOError) as e:
-                print(f"Error loading database: {e}")
-                return {}
-        return {}
-    
-    def _save_data(self) -> None:
-        """Save data to JSON file."""
+                data[streamer_id] = _subscription_from_record(record)
+            except (TypeError, AttributeError):
+                print(f"Skipping malformed record {streamer_id!r} in {self.db_file}")
+        if len(data) < len(raw):
+            self._set_aside_snapshot(move=False)
+        return data
+    
+    def _set_aside_snapshot(self, move: bool) -> None:
+        """Keep the current snapshot as <db_file>.bad-<timestamp> before anything can overwrite it."""
+        target = f"{self.db_file}.bad-{time.time_ns()}"
+        try:
+            if move:
+                os.replace(self.db_file, target)
+            else:
+                shutil.copy2(self.db_file, target)
+            print(f"Kept the original database snapshot as {target}")
+        except OSError as e:
+            print(f"Could not keep a copy of {self.db_file} ({e}); compaction is disabled")
+            self._compaction_disabled = True
+    
+    def _replay_log(self) -> None:
+        """Apply mutations logged since the last snapshot to self.data.
+        
+        A crash mid-append can leave a partial record at the end of the log. It is
+        cut off here so that the next append starts on a line of its own.
+        """
         try:
-            with open(self.db_file, 'w') as f:
-                json.dump(self.data, f, indent=2)
+            with open(self.log_file, 'r+b') as f:
+                complete_bytes = 0
+                torn = False
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        torn = True
+                        break
+                    complete_bytes += len(line)
+                    try:
+                        record = json_loads(line)
+                        if record['op'] == 'put':
+                            self.data[record['k']] = _subscription_from_record(record['v'])
+                        elif record['op'] == 'del':
+                            self.data.pop(record['k'], None)
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        print(f"Skipping corrupt log record in {self.log_file}")
+                if torn:
+                    print(f"Discarding incomplete record at the end of {self.log_file}")
+                    f.truncate(complete_bytes)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error replaying database log: {e}")
+    
+    def _save_data(self) -> bool:
+        """Atomically save data to JSON file via a temporary file and os.replace."""
+        if self._compaction_disabled:
+            return False
+        tmp_file = self.db_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                # dict() copies atomically under the GIL, so no lock is needed here.
+                f.write(json_dumps(dict(self.data), newline=True))
+                # Make sure the new snapshot is on disk before it replaces the old one.
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.db_file)
+            return True
         except IOError as e:
             print(f"Error saving database: {e}")
+            return False
+    
+    def _append_log(self, record: Dict) -> None:
+        """Queue a mutation record for the writer thread."""
+        self._write_q.put(record)
+    
+    def _writer_loop(self) -> None:
+        """Drain the write queue, writing each burst of records in one batch."""
+        while True:
+            records = [self._write_q.get()]
+            while True:
+                try:
+                    records.append(self._write_q.get(timeout=self.WRITE_COALESCE_DELAY))
+                except queue.Empty:
+                    break
+            try:
+                self._write_records(records)
+            except Exception as e:
+                print(f"Error in database writer: {e}")
+            finally:
+                for _ in records:
+                    self._write_q.task_done()
+    
+    def _write_records(self, records: List[Dict]) -> None:
+        """Append records to the log, compacting if it has grown too large."""
+        with self._log_lock:
+            try:
+                self._log.write(b''.join(json_dumps(record, newline=True) for record in records))
+            except IOError as e:
+                print(f"Error writing database log: {e}")
+                return
+            threshold = max(2 * len(self.data) * self.RECORD_SIZE_ESTIMATE, self.MIN_COMPACT_BYTES)
+            if self._log.tell() > threshold and self._save_data():
+                self._log.truncate(0)
+    
+    def compact(self) -> None:
+        """Write a full snapshot and truncate the mutation log."""
+        with self._log_lock:
+            if self._save_data():
+                self._log.truncate(0)
+    
+    def flush(self) -> None:
+        """Block until every queued mutation has been written to disk."""
+        self._write_q.join()
+    
+    def _index(self, streamer_id: str, sub: Subscription) -> None:
+        """Add a subscription to the guild, platform, name and ID indexes."""
+        self._by_guild[sub.guild_id].add(streamer_id)
+        self._by_platform[sub.platform].add(streamer_id)
+        # Only Twitch names are unique; YouTube channel titles can repeat within a guild.
+        if sub.platform == 'twitch':
+            self._by_name[(sub.guild_id, sub.platform, sub.name.lower())] = streamer_id
+        self._by_lower_id[streamer_id.lower()] = streamer_id
+    
+    def _unindex(self, streamer_id: str, sub: Subscription) -> None:
+        """Remove a subscription from the guild, platform, name and ID indexes."""
+        self._by_guild[sub.guild_id].discard(streamer_id)
+        self._by_platform[sub.platform].discard(streamer_id)
+        name_key = (sub.guild_id, sub.platform, sub.name.lower())
+        if self._by_name.get(name_key) == streamer_id:
+            del self._by_name[name_key]
+        if self._by_lower_id.get(streamer_id.lower()) == streamer_id:
+            del self._by_lower_id[streamer_id.lower()]
     
     def add_subscription(self, streamer_id: str, platform: str, guild_id: int, 
                         channel_id: int, name: str, subscription_id: Optional[str] = None, 
-                        custom_message: Optional[str] = None) -> None:
+                        custom_message: Optional[str] = None, thumbnail_url: Optional[str] = None,
+                        stream_url: Optional[str] = None, lease_expiry: Optional[float] = None) -> None:
         """Add a new stream subscription."""
-        self.data[streamer_id] = {
-            'platform': platform,
-            'guild_id': guild_id,
-            'channel_id': channel_id,
-            'name': name,
-            'subscription_id': subscription_id,
-            'custom_message': custom_message
-        }
-        self._save_data()
-    
-    def remove_subscription(self, streamer_id: str) -> Optional[Dict]:
+        sub = Subscription(platform, guild_id, channel_id, name, subscription_id, custom_message,
+                           thumbnail_url, stream_url, lease_expiry)
+        with self._lock:
+            self._put(streamer_id, sub)
+    
+    def add_subscription_if_absent(self, streamer_id: str, platform: str, guild_id: int,
+                                   channel_id: int, name: str, subscription_id: Optional[str] = None,
+                                   custom_message: Optional[str] = None, thumbnail_url: Optional[str] = None,
+                                   stream_url: Optional[str] = None, lease_expiry: Optional[float] = None) -> bool:
+        """Add a new stream subscription unless the streamer is already subscribed; return whether it was added."""
+        sub = Subscription(platform, guild_id, channel_id, name, subscription_id, custom_message,
+                           thumbnail_url, stream_url, lease_expiry)
+        with self._lock:
+            if streamer_id in self.data:
+                return False
+            self._put(streamer_id, sub)
+            return True
+    
+    def _put(self, streamer_id: str, sub: Subscription) -> None:
+        """Store a subscription, replacing any previous one, and log it. Caller holds self._lock."""
+        previous = self.data.get(streamer_id)
+        if previous:
+            self._unindex(streamer_id, previous)
+        self.data[streamer_id] = sub
+        self._index(streamer_id, sub)
+        self._append_log({'op': 'put', 'k': streamer_id, 'v': sub})
+    
+    def update_subscription(self, streamer_id: str, **changes) -> Optional[Subscription]:
+        """Replace fields of an existing subscription and return the updated record."""
+        with self._lock:
+            current = self.data.get(streamer_id)
+            if current is None:
+                return None
+            updated = replace(current, **changes)
+            self._unindex(streamer_id, current)
+            self.data[streamer_id] = updated
+            self._index(streamer_id, updated)
+            self._append_log({'op': 'put', 'k': streamer_id, 'v': updated})
+            return updated
+    
+    def remove_subscription(self, streamer_id: str) -> Optional[Subscription]:
         """Remove a stream subscription and return the removed data."""
-        removed = self.data.pop(streamer_id, None)
-        if removed:
-            self._save_data()
-        return removed
+        with self._lock:
+            removed = self.data.pop(streamer_id, None)
+            if removed:
+                self._unindex(streamer_id, removed)
+                self._append_log({'op': 'del', 'k': streamer_id})
+            return removed
     
-    def get_subscription(self, streamer_id: str) -> Optional[Dict]:
+    def get_subscription(self, streamer_id: str) -> Optional[Subscription]:
         """Get a specific subscription."""
-        return self.data.get(streamer_id)
+        with self._lock:
+            return self.data.get(streamer_id)
+    
+    def get_subscriptions_by_guild(self, guild_id: int) -> Dict[str, Subscription]:
+        """Get all subscriptions for a specific Discord guild.
+        
+        Prefer iter_subscriptions_by_guild() when the result is only iterated.
+        """
+        with self._lock:
+            return {streamer_id: self.data[streamer_id] for streamer_id in self._by_guild.get(guild_id, ())}
+    
+    def iter_subscriptions_by_guild(self, guild_id: int) -> Iterator[Tuple[str, Subscription]]:
+        """Yield (streamer_id, subscription) pairs for a specific Discord guild without building a dict."""
+        with self._lock:
+            streamer_ids = tuple(self._by_guild.get(guild_id, ()))
+        for streamer_id in streamer_ids:
+            sub = self.data.get(streamer_id)
+            if sub is not None:
+                yield streamer_id, sub
+    
+    def find_by_name(self, guild_id: int, platform: str, name: str) -> Optional[str]:
+        """Get the streamer ID subscribed under a Twitch name (case-insensitive) in a guild."""
+        with self._lock:
+            return self._by_name.get((guild_id, platform, name.lower()))
     
-    def get_subscriptions_by_guild(self, guild_id: int) -> Dict[str, Dict]:
-        """Get all subscriptions for a specific Discord guild."""
-        return {
-            streamer_id: data for streamer_id, data in self.data.items()
-            if data['guild_id'] == guild_id
-        }
+    def find_subscription(self, guild_id: int, platform: str, identifier: str) -> Optional[Tuple[str, Subscription]]:
+        """Find a guild's subscription by Twitch name or by streamer ID, both case-insensitive.
+        
+        Returns a (streamer_id, subscription) pair, or None if the guild has no
+        matching subscription on that platform.
+        """
+        with self._lock:
+            streamer_id = self._by_name.get((guild_id, platform, identifier.lower()))
+            if streamer_id is None:
+                streamer_id = identifier if identifier in self.data else self._by_lower_id.get(identifier.lower())
+            sub = self.data.get(streamer_id) if streamer_id else None
+            if sub is None or sub.guild_id != guild_id or sub.platform != platform:
+                return None
+            return streamer_id, sub
     
-    def get_all_subscriptions(self) -> Dict[str, Dict]:
+    def get_all_subscriptions(self) -> Dict[str, Subscription]:
         """Get all subscriptions."""
-        return self.data.copy()
+        with self._lock:
+            return self.data.copy()
     
     def subscription_exists(self, streamer_id: str) -> bool:
         """Check if a subscription exists."""
-        return streamer_id in self.data
+        with self._lock:
+            return streamer_id in self.data
     
-    def get_subscriptions_by_platform(self, platform: str) -> Dict[str, Dict]:
+    def get_subscriptions_by_platform(self, platform: str) -> Dict[str, Subscription]:
         """Get all subscriptions for a specific platform."""
-        return {
-            streamer_id: data for streamer_id, data in self.data.items()
-            if data['platform'] == platform
-        }
+        with self._lock:
+            return {streamer_id: self.data[streamer_id] for streamer_id in self._by_platform.get(platform, ())}
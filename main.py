@@ -1,16 +1,28 @@
 # main.py (Final Version)
 
+import asyncio
 import discord
+from discord.ext import tasks
 import requests
-import json
 import threading
+import time
 import hmac
 import hashlib
-import xmltodict
+import re
+import secrets
+from urllib.parse import parse_qs, urlsplit
+from collections import OrderedDict
+from datetime import datetime, timezone
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request, abort, Response
-from typing import Optional, Dict
-from database import StreamDatabase
-from config import *
+from waitress import serve
+from typing import Optional, Dict, List, Tuple
+from database import StreamDatabase, Subscription, json_dumps, json_loads
+import config
 
 # Initialize Discord Bot client
 intents = discord.Intents.default()
@@ -21,67 +33,179 @@ tree = discord.app_commands.CommandTree(bot)
 # Initialize Flask web server
 app = Flask(__name__)
 
+# Runs notification follow-up work (Helix lookups, embed building) so webhooks can be acknowledged immediately
+WEBHOOK_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='webhook')
+
 # Initialize Database
 db = StreamDatabase()
 
-# Stores the Twitch App Access Token
+# Rendered /list embeds per guild as (build time, embed); dropped whenever the guild's subscriptions change
+LIST_CACHE_TTL = 300
+list_cache: Dict[int, Tuple[float, discord.Embed]] = {}
+
+# Webhook signing key, encoded once instead of on every request
+WEBHOOK_SECRET_BYTES = config.WEBHOOK_SECRET.encode('utf-8') if config.WEBHOOK_SECRET else None
+# Keyed HMAC with the pads already computed; each request hashes into a .copy() of it
+WEBHOOK_HMAC_TEMPLATE = hmac.new(WEBHOOK_SECRET_BYTES, digestmod=hashlib.sha256) if WEBHOOK_SECRET_BYTES else None
+
+# Stores the Twitch App Access Token and the Unix time at which it expires
 TWITCH_ACCESS_TOKEN = None
+TWITCH_TOKEN_EXPIRES_AT = 0.0
+
+# Refresh the Twitch token this many seconds before it expires
+TWITCH_TOKEN_REFRESH_MARGIN = 300
+twitch_refresh_timer: Optional[threading.Timer] = None
+# Serializes token refreshes; after a failed refresh, callers wait this many seconds before trying again
+twitch_token_lock = threading.Lock()
+TWITCH_TOKEN_RETRY_DELAY = 30
+twitch_token_retry_at = 0.0
+
+# Pooled HTTP sessions so TCP/TLS connections are reused across API calls. Idempotent requests that
+# hit a server error are retried with backoff; the last response is returned either way. Read timeouts
+# are never retried, so a request's timeout bounds how long it can take to fail.
+HTTP_RETRY = Retry(total=3, connect=1, read=False, backoff_factor=0.2,
+                   status_forcelist=[500, 502, 503, 504], raise_on_status=False)
+TWITCH_SESSION = requests.Session()
+TWITCH_SESSION.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=HTTP_RETRY))
+# The stream-details lookup has its own short timeout budget, so it gets no retries at all.
+TWITCH_SESSION.mount('https://api.twitch.tv/helix/streams', HTTPAdapter(pool_connections=1, pool_maxsize=8))
+# Sent with every Helix call; the Authorization header is set whenever the token is refreshed
+TWITCH_SESSION.headers['Client-ID'] = config.TWITCH_CLIENT_ID
+YOUTUBE_SESSION = requests.Session()
+# Google sends Retry-After with its 429s, which urllib3 honours
+YOUTUBE_SESSION.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20,
+                                              max_retries=HTTP_RETRY.new(status_forcelist=[429, 500, 502, 503, 504])))
+
+# Twitch signals when its rate-limit bucket refills with Ratelimit-Reset (a Unix time) instead of
+# Retry-After. A 429 is retried once after waiting for the reset, unless that is further away than this.
+TWITCH_RATELIMIT_MAX_WAIT = 5
+
+# Extra headers for requests whose body is pre-encoded JSON
+JSON_HEADERS = {'Content-Type': 'application/json'}
 
 # --- TWITCH API HELPER FUNCTIONS ---
 
 def get_twitch_app_access_token() -> Optional[str]:
-    """Get Twitch application access token."""
-    global TWITCH_ACCESS_TOKEN
+    """Get Twitch application access token and schedule its proactive refresh."""
+    global TWITCH_ACCESS_TOKEN, TWITCH_TOKEN_EXPIRES_AT
     params = {
-        'client_id': TWITCH_CLIENT_ID,
-        'client_secret': TWITCH_CLIENT_SECRET,
+        'client_id': config.TWITCH_CLIENT_ID,
+        'client_secret': config.TWITCH_CLIENT_SECRET,
         'grant_type': 'client_credentials'
     }
     try:
-        response = requests.post(TWITCH_TOKEN_URL, params=params)
+        response = TWITCH_SESSION.post(config.TWITCH_TOKEN_URL, params=params, timeout=config.HTTP_TIMEOUT)
         response.raise_for_status()
-        TWITCH_ACCESS_TOKEN = response.json()['access_token']
+        data = json_loads(response.content)
+        TWITCH_ACCESS_TOKEN = data['access_token']
+        TWITCH_SESSION.headers['Authorization'] = f'Bearer {TWITCH_ACCESS_TOKEN}'
+        TWITCH_TOKEN_EXPIRES_AT = time.time() + data['expires_in']
+        schedule_twitch_token_refresh(data['expires_in'])
         print("Successfully refreshed Twitch App Access Token.")
         return TWITCH_ACCESS_TOKEN
     except Exception as e:
         print(f"Error getting Twitch token: {e}")
-        TWITCH_ACCESS_TOKEN = None
+        # Keep a token that is still valid; only forget it once it has actually expired.
+        if time.time() >= TWITCH_TOKEN_EXPIRES_AT:
+            TWITCH_ACCESS_TOKEN = None
         return None
 
-def get_twitch_user_id(username: str) -> Optional[str]:
-    """Get Twitch user ID from username."""
-    if not TWITCH_ACCESS_TOKEN:
-        get_twitch_app_access_token()
-    if not TWITCH_ACCESS_TOKEN:
+def refresh_twitch_token(stale_token: Optional[str]) -> bool:
+    """Replace stale_token with a fresh token unless another thread already has.
+    
+    Concurrent callers share one token request, and after a failed refresh further
+    attempts are skipped for TWITCH_TOKEN_RETRY_DELAY seconds. Returns True if a
+    token other than stale_token is available.
+    """
+    global twitch_token_retry_at
+    with twitch_token_lock:
+        if TWITCH_ACCESS_TOKEN != stale_token:
+            return TWITCH_ACCESS_TOKEN is not None
+        if time.time() < twitch_token_retry_at:
+            return False
+        if get_twitch_app_access_token():
+            return True
+        twitch_token_retry_at = time.time() + TWITCH_TOKEN_RETRY_DELAY
+        return False
+
+def schedule_twitch_token_refresh(expires_in: float) -> None:
+    """Refresh the Twitch token in the background shortly before it expires."""
+    global twitch_refresh_timer
+    if twitch_refresh_timer:
+        twitch_refresh_timer.cancel()
+    twitch_refresh_timer = threading.Timer(max(expires_in - TWITCH_TOKEN_REFRESH_MARGIN, 60),
+                                           lambda: refresh_twitch_token(TWITCH_ACCESS_TOKEN))
+    twitch_refresh_timer.daemon = True
+    twitch_refresh_timer.start()
+
+def twitch_ratelimit_wait(response: requests.Response) -> Optional[float]:
+    """Seconds until a rate-limited Helix bucket refills, or None if it is unknown or too far off."""
+    try:
+        wait = float(response.headers['Ratelimit-Reset']) - time.time()
+    except (KeyError, ValueError):
         return None
+    return max(wait, 0.0) if wait <= TWITCH_RATELIMIT_MAX_WAIT else None
+
+def twitch_request(method: str, url: str, **kwargs) -> requests.Response:
+    """Send an authenticated Helix request, refreshing the token and retrying once on a 401 or 429."""
+    # Normally the refresh timer renews the token first; this covers a timer that fell behind or a failed refresh.
+    if time.time() >= TWITCH_TOKEN_EXPIRES_AT - TWITCH_TOKEN_REFRESH_MARGIN:
+        refresh_twitch_token(TWITCH_ACCESS_TOKEN)
+    token = TWITCH_ACCESS_TOKEN
+    if not token:
+        raise RuntimeError("No Twitch access token available")
+    kwargs.setdefault('timeout', config.HTTP_TIMEOUT)
     
-    headers = {
-        'Client-ID': TWITCH_CLIENT_ID,
-        'Authorization': f'Bearer {TWITCH_ACCESS_TOKEN}'
-    }
-    params = {'login': username.lower()}
+    response = TWITCH_SESSION.request(method, url, **kwargs)
+    if response.status_code == 401 and refresh_twitch_token(token):
+        response = TWITCH_SESSION.request(method, url, **kwargs)
+    if response.status_code == 429:
+        wait = twitch_ratelimit_wait(response)
+        if wait is not None:
+            time.sleep(wait)
+            response = TWITCH_SESSION.request(method, url, **kwargs)
+    return response
+
+def twitch_thumbnail_url(user_id: str) -> str:
+    """Build the profile thumbnail URL for a Twitch user."""
+    return f"https://static-cdn.jtvnw.net/jtv_user_pictures/{user_id}-profile_image-300x300.png"
+
+# Twitch user IDs by lowercased login, as (user_id, fetched_at). Only successful lookups are stored,
+# and entries expire after the TTL so a login that changes hands resolves to its new owner.
+TWITCH_USER_ID_CACHE_SIZE = 4096
+TWITCH_USER_ID_CACHE_TTL = 60 * 60
+twitch_user_id_cache: Dict[str, Tuple[str, float]] = {}
+
+def get_twitch_user_id(username: str) -> Optional[str]:
+    """Get Twitch user ID from username, using the in-memory cache when possible."""
+    login = username.lower()
+    cached = twitch_user_id_cache.get(login)
+    if cached and time.monotonic() - cached[1] < TWITCH_USER_ID_CACHE_TTL:
+        return cached[0]
+    params = {'login': login}
     
     try:
-        response = requests.get(TWITCH_USERS_URL, headers=headers, params=params)
-        response.raise_for_status()
-        data = response.json()
-        return data['data'][0]['id'] if data.get('data') else None
+        response = twitch_request('GET', config.TWITCH_USERS_URL, params=params)
+        if response.status_code != 200:
+            print(f"Error getting Twitch user ID for {username}: HTTP {response.status_code}")
+            return None
+        data = json_loads(response.content)
+        # Drop any expired entry first, so a login that no longer exists isn't left cached.
+        twitch_user_id_cache.pop(login, None)
+        if not data.get('data'):
+            return None
+        user_id = data['data'][0]['id']
+        if len(twitch_user_id_cache) >= TWITCH_USER_ID_CACHE_SIZE:
+            # Evict the oldest entry; dicts keep insertion order.
+            twitch_user_id_cache.pop(next(iter(twitch_user_id_cache)), None)
+        twitch_user_id_cache[login] = (user_id, time.monotonic())
+        return user_id
     except Exception as e:
         print(f"Error getting Twitch user ID for {username}: {e}")
         return None
 
 def create_twitch_subscription(user_id: str, callback_url: str) -> Optional[str]:
     """Create Twitch EventSub subscription."""
-    if not TWITCH_ACCESS_TOKEN:
-        get_twitch_app_access_token()
-    if not TWITCH_ACCESS_TOKEN:
-        return None
-    
-    headers = {
-        'Client-ID': TWITCH_CLIENT_ID,
-        'Authorization': f'Bearer {TWITCH_ACCESS_TOKEN}',
-        'Content-Type': 'application/json'
-    }
     payload = {
         'type': 'stream.online',
         'version': '1',
@@ -89,36 +213,29 @@ def create_twitch_subscription(user_id: str, callback_url: str) -> Optional[str]
         'transport': {
             'method': 'webhook',
             'callback': callback_url,
-            'secret': WEBHOOK_SECRET
+            'secret': config.WEBHOOK_SECRET
         }
     }
     
-    response = None
     try:
-        response = requests.post(TWITCH_EVENTSUB_URL, headers=headers, json=payload)
-        response.raise_for_status()
-        return response.json()['data'][0]['id']
+        response = twitch_request('POST', config.TWITCH_EVENTSUB_URL, data=json_dumps(payload),
+                                  headers=JSON_HEADERS)
+        if response.status_code >= 400:
+            print(f"Error creating Twitch subscription: HTTP {response.status_code}")
+            print(f"Response: {response.text}")
+            return None
+        return json_loads(response.content)['data'][0]['id']
     except Exception as e:
         print(f"Error creating Twitch subscription: {e}")
-        if response and hasattr(response, 'text'):
-            print(f"Response: {response.text}")
         return None
 
 def delete_twitch_subscription(subscription_id: str) -> bool:
     """Delete a specific Twitch subscription."""
-    if not TWITCH_ACCESS_TOKEN:
-        get_twitch_app_access_token()
-    if not TWITCH_ACCESS_TOKEN:
-        return False
-    
-    headers = {
-        'Client-ID': TWITCH_CLIENT_ID,
-        'Authorization': f'Bearer {TWITCH_ACCESS_TOKEN}'
-    }
-    
     try:
-        response = requests.delete(f'{TWITCH_EVENTSUB_URL}?id={subscription_id}', headers=headers)
-        response.raise_for_status()
+        response = twitch_request('DELETE', f'{config.TWITCH_EVENTSUB_URL}?id={subscription_id}')
+        if response.status_code >= 400:
+            print(f"Error deleting Twitch subscription {subscription_id}: HTTP {response.status_code}")
+            return False
         print(f"Deleted Twitch subscription {subscription_id}")
         return True
     except Exception as e:
@@ -126,41 +243,53 @@ def delete_twitch_subscription(subscription_id: str) -> bool:
         return False
 
 def delete_all_twitch_subscriptions() -> None:
-    """Delete all existing Twitch subscriptions."""
-    if not TWITCH_ACCESS_TOKEN:
-        get_twitch_app_access_token()
-    if not TWITCH_ACCESS_TOKEN:
-        return
-    
-    headers = {
-        'Client-ID': TWITCH_CLIENT_ID,
-        'Authorization': f'Bearer {TWITCH_ACCESS_TOKEN}'
-    }
-    
+    """Delete all existing Twitch subscriptions, issuing the deletes concurrently."""
+    subscription_ids = []
+    cursor = None
     try:
-        response = requests.get(TWITCH_EVENTSUB_URL, headers=headers)
-        response.raise_for_status()
-        subscriptions = response.json().get('data', [])
-        for sub in subscriptions:
-            requests.delete(f'{TWITCH_EVENTSUB_URL}?id={sub["id"]}', headers=headers)
-            print(f"Deleted old Twitch subscription {sub['id']}")
+        # Collect every page first; deleting while paginating would invalidate the cursor.
+        while True:
+            params = {'after': cursor} if cursor else None
+            response = twitch_request('GET', config.TWITCH_EVENTSUB_URL, params=params)
+            response.raise_for_status()
+            page = json_loads(response.content)
+            subscription_ids.extend(sub['id'] for sub in page.get('data', []))
+            cursor = page.get('pagination', {}).get('cursor')
+            if not cursor:
+                break
     except Exception as e:
-        print(f"An error occurred while deleting Twitch subscriptions: {e}")
+        print(f"An error occurred while listing Twitch subscriptions: {e}")
+    
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        deleted = sum(executor.map(delete_twitch_subscription, subscription_ids))
+    print(f"Deleted {deleted} of {len(subscription_ids)} old Twitch subscription(s)")
 
 # --- YOUTUBE API HELPER FUNCTIONS ---
 
+# Hub lease requested for each subscription (10 days). The hub may grant less and reports the actual
+# lease on its verification request; renew_youtube_subscriptions renews it before it runs out.
+YOUTUBE_LEASE_SECONDS = 864000
+# Renew leases ending within this window. The renewal loop runs daily, so this must exceed a day.
+YOUTUBE_LEASE_RENEW_BEFORE = 2 * 24 * 60 * 60
+# hub.verify_token sent with each outstanding subscribe request, keyed by channel ID. Verification
+# requests are unsigned, so only one echoing the matching token may set a lease.
+youtube_verify_tokens: Dict[str, str] = {}
+# Leases the hub verified before /add had stored the subscription, keyed by channel ID
+youtube_granted_leases: Dict[str, float] = {}
+youtube_lease_lock = threading.Lock()
+
 def get_youtube_channel_info(channel_id: str) -> Optional[Dict]:
     """Get YouTube channel information."""
     params = {
         'part': 'snippet',
         'id': channel_id,
-        'key': YOUTUBE_API_KEY
+        'key': config.YOUTUBE_API_KEY
     }
     
     try:
-        response = requests.get(YOUTUBE_CHANNELS_URL, params=params)
+        response = YOUTUBE_SESSION.get(config.YOUTUBE_CHANNELS_URL, params=params, timeout=config.HTTP_TIMEOUT)
         response.raise_for_status()
-        data = response.json()
+        data = json_loads(response.content)
         return data['items'][0]['snippet'] if data.get('items') else None
     except Exception as e:
         print(f"Error getting YouTube channel info for {channel_id}: {e}")
@@ -169,38 +298,156 @@ def get_youtube_channel_info(channel_id: str) -> Optional[Dict]:
 def create_youtube_subscription(channel_id: str, callback_url: str) -> bool:
     """Subscribe to YouTube channel's PubSubHubbub feed."""
     topic_url = f"https://www.youtube.com/xml/feeds/videos.xml?channel_id={channel_id}"
+    verify_token = secrets.token_urlsafe(16)
     data = {
         'hub.mode': 'subscribe',
         'hub.topic': topic_url,
         'hub.callback': callback_url,
-        'hub.secret': WEBHOOK_SECRET,
-        'hub.lease_seconds': 864000  # 10 days
+        'hub.secret': config.WEBHOOK_SECRET,
+        'hub.lease_seconds': YOUTUBE_LEASE_SECONDS,
+        'hub.verify_token': verify_token
     }
+    # Registered before the request goes out, since the hub may verify before it responds.
+    with youtube_lease_lock:
+        youtube_verify_tokens[channel_id] = verify_token
     
     try:
-        response = requests.post(YOUTUBE_PUBSUB_URL, data=data)
-        return response.status_code in [200, 202, 204]
+        response = YOUTUBE_SESSION.post(config.YOUTUBE_PUBSUB_URL, data=data, timeout=config.HTTP_TIMEOUT)
+        if response.status_code in [200, 202, 204]:
+            return True
     except Exception as e:
         print(f"Error creating YouTube subscription: {e}")
-        return False
+    with youtube_lease_lock:
+        if youtube_verify_tokens.get(channel_id) == verify_token:
+            del youtube_verify_tokens[channel_id]
+    return False
+
+# --- DISCORD CHANNEL CACHE ---
+
+# Notification channels resolved by get_cached_channel, keyed by channel ID
+channel_cache: Dict[int, discord.abc.Messageable] = {}
+
+def get_cached_channel(channel_id: int) -> Optional[discord.abc.Messageable]:
+    """Resolve a channel with bot.get_channel, caching it for later webhook deliveries."""
+    channel = channel_cache.get(channel_id)
+    if channel is None:
+        channel = bot.get_channel(channel_id)
+        if channel is not None:
+            channel_cache[channel_id] = channel
+    return channel
+
+# --- DISCORD NOTIFICATION SENDING ---
+
+# Caps concurrent notification sends so go-live bursts don't all hit Discord's rate limits at once.
+# Created in setup_hook so it belongs to the bot's event loop.
+NOTIFICATION_SEND_LIMIT = 20
+notification_semaphore: Optional[asyncio.Semaphore] = None
+
+# Set once on_ready has deleted the old Twitch subscriptions; /add waits for it so a new
+# EventSub can't be listed and deleted by that cleanup. Created in setup_hook.
+twitch_cleanup_done: Optional[asyncio.Event] = None
+
+async def gated_send(channel: discord.abc.Messageable, **kwargs) -> None:
+    """Send a notification message, waiting for a free slot under NOTIFICATION_SEND_LIMIT."""
+    async with notification_semaphore:
+        await channel.send(**kwargs)
+
+# Notifications for one channel that arrive within this window are combined into as few messages as possible
+NOTIFICATION_BATCH_WINDOW = 0.25
+# Discord allows at most 10 embeds per message
+NOTIFICATION_BATCH_SIZE = 10
+# (content, embed) pairs waiting for their channel's window to close, keyed by channel ID.
+# Only touched from the event loop, so it needs no lock.
+pending_notifications: Dict[int, List[Tuple[Optional[str], discord.Embed]]] = {}
+
+async def queue_notification(channel: discord.abc.Messageable, content: Optional[str], embed: discord.Embed) -> None:
+    """Queue a notification for a channel, sending everything queued for it once the batch window closes."""
+    pending = pending_notifications.get(channel.id)
+    if pending is not None:
+        pending.append((content, embed))
+        return
+    
+    pending = pending_notifications[channel.id] = [(content, embed)]
+    await asyncio.sleep(NOTIFICATION_BATCH_WINDOW)
+    del pending_notifications[channel.id]
+    
+    # Consecutive notifications with the same custom message share a send, so every message keeps its own text.
+    for batch_content, group in groupby(pending, key=lambda item: item[0]):
+        embeds = [embed for _, embed in group]
+        for start in range(0, len(embeds), NOTIFICATION_BATCH_SIZE):
+            try:
+                await gated_send(channel, content=batch_content, embeds=embeds[start:start + NOTIFICATION_BATCH_SIZE])
+            except Exception as e:
+                print(f"Failed to send notification to channel {channel.id}: {e}")
+
+# --- YOUTUBE LEASE RENEWAL ---
+
+@tasks.loop(hours=24)
+async def renew_youtube_subscriptions():
+    """Re-subscribe to every YouTube feed whose hub lease expires within YOUTUBE_LEASE_RENEW_BEFORE.
+    
+    The new expiry is recorded when the hub sends its verification request, not here.
+    """
+    cutoff = time.time() + YOUTUBE_LEASE_RENEW_BEFORE
+    due = [channel_id for channel_id, sub in db.get_subscriptions_by_platform('youtube').items()
+           if sub.lease_expiry is None or sub.lease_expiry < cutoff]
+    if not due:
+        return
+    
+    callback_url = f"{config.WEBHOOK_BASE_URL}/webhooks/youtube"
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*(
+        loop.run_in_executor(None, create_youtube_subscription, channel_id, callback_url) for channel_id in due
+    ))
+    print(f"Renewed {sum(results)} of {len(due)} YouTube subscription(s)")
 
 # --- DISCORD BOT EVENTS & COMMANDS ---
 
+@bot.event
+async def setup_hook():
+    """Create loop-bound state before the gateway connects, so no notification can arrive ahead of it."""
+    global notification_semaphore, twitch_cleanup_done
+    notification_semaphore = asyncio.Semaphore(NOTIFICATION_SEND_LIMIT)
+    twitch_cleanup_done = asyncio.Event()
+
 @bot.event
 async def on_ready():
     """Bot ready event handler."""
     print(f'Logged in as {bot.user}')
-    print("Deleting all old Twitch subscriptions...")
-    delete_all_twitch_subscriptions()
+    if not renew_youtube_subscriptions.is_running():
+        renew_youtube_subscriptions.start()
     
-    try:
-        synced = await tree.sync()
-        print(f"Synced {len(synced)} command(s)")
-    except Exception as e:
-        print(f"Failed to sync commands: {e}")
+    async def sync_commands():
+        try:
+            synced = await tree.sync()
+            print(f"Synced {len(synced)} command(s)")
+        except Exception as e:
+            print(f"Failed to sync commands: {e}")
+    
+    # The cleanup is blocking HTTP, so run it off the event loop while the commands sync.
+    async def delete_old_subscriptions():
+        twitch_cleanup_done.clear()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, delete_all_twitch_subscriptions)
+        finally:
+            twitch_cleanup_done.set()
+    
+    print("Deleting all old Twitch subscriptions...")
+    await asyncio.gather(delete_old_subscriptions(), sync_commands())
     
     print("Bot is ready.")
 
+@bot.event
+async def on_guild_channel_delete(channel):
+    """Drop deleted channels from the channel cache."""
+    channel_cache.pop(channel.id, None)
+
+@bot.event
+async def on_guild_remove(guild):
+    """Drop a guild's channels from the channel cache once the bot leaves it."""
+    for channel in guild.channels:
+        channel_cache.pop(channel.id, None)
+
 @tree.command(name="add", description="Subscribe to a Twitch streamer or YouTube channel")
 @discord.app_commands.describe(
     platform="Choose the platform (twitch or youtube)",
@@ -216,11 +463,13 @@ async def add_command(interaction: discord.Interaction, platform: str, identifie
                      notification_channel: discord.TextChannel = None, custom_message: str = None):
     """Handle /add command to subscribe to a streamer."""
     await interaction.response.defer(ephemeral=True)
+    # The API helpers use blocking requests calls, so they run in worker threads via asyncio.to_thread.
     
     target_channel = notification_channel if notification_channel else interaction.channel
     
     if platform == 'twitch':
-        user_id = get_twitch_user_id(identifier)
+        await twitch_cleanup_done.wait()
+        user_id = await asyncio.to_thread(get_twitch_user_id, identifier)
         if not user_id:
             await interaction.followup.send(f"❌ Could not find a Twitch user named `{identifier}`.")
             return
@@ -229,19 +478,27 @@ async def add_command(interaction: discord.Interaction, platform: str, identifie
             await interaction.followup.send(f"`{identifier}` is already being watched!")
             return
         
-        callback_url = f"{WEBHOOK_BASE_URL}/webhooks/twitch"
-        sub_id = create_twitch_subscription(user_id, callback_url)
+        callback_url = f"{config.WEBHOOK_BASE_URL}/webhooks/twitch"
+        sub_id = await asyncio.to_thread(create_twitch_subscription, user_id, callback_url)
         if sub_id:
-            db.add_subscription(
+            # Another /add may have taken this streamer while the API calls ran; the database decides.
+            added = db.add_subscription_if_absent(
                 user_id, 'twitch', interaction.guild_id, 
-                target_channel.id, identifier.lower(), sub_id, custom_message
+                target_channel.id, identifier.lower(), sub_id, custom_message,
+                thumbnail_url=twitch_thumbnail_url(user_id),
+                stream_url=f"https://twitch.tv/{identifier.lower()}"
             )
+            if not added:
+                await asyncio.to_thread(delete_twitch_subscription, sub_id)
+                await interaction.followup.send(f"`{identifier}` is already being watched!")
+                return
+            list_cache.pop(interaction.guild_id, None)
             await interaction.followup.send(f"✅ Subscribed to live notifications for **{identifier}** on Twitch!")
         else:
             await interaction.followup.send("❌ Failed to create Twitch webhook.")
 
     elif platform == 'youtube':
-        channel_info = get_youtube_channel_info(identifier)
+        channel_info = await asyncio.to_thread(get_youtube_channel_info, identifier)
         if not channel_info:
             await interaction.followup.send(f"❌ Could not find a YouTube channel with ID `{identifier}`.")
             return
@@ -250,12 +507,23 @@ async def add_command(interaction: discord.Interaction, platform: str, identifie
             await interaction.followup.send(f"`{channel_info['title']}` is already being watched!")
             return
         
-        callback_url = f"{WEBHOOK_BASE_URL}/webhooks/youtube"
-        if create_youtube_subscription(identifier, callback_url):
-            db.add_subscription(
-                identifier, 'youtube', interaction.guild_id,
-                target_channel.id, channel_info['title'], None, custom_message
-            )
+        callback_url = f"{config.WEBHOOK_BASE_URL}/webhooks/youtube"
+        if await asyncio.to_thread(create_youtube_subscription, identifier, callback_url):
+            # The hub may already have verified the lease; hold the lock so it can't land in between.
+            with youtube_lease_lock:
+                lease_expiry = youtube_granted_leases.pop(identifier, None)
+                # Another /add may have taken this channel while the API calls ran; the database decides.
+                added = db.add_subscription_if_absent(
+                    identifier, 'youtube', interaction.guild_id,
+                    target_channel.id, channel_info['title'], None, custom_message,
+                    lease_expiry=lease_expiry
+                )
+                if not added and lease_expiry is not None:
+                    db.update_subscription(identifier, lease_expiry=lease_expiry)
+            if not added:
+                await interaction.followup.send(f"`{channel_info['title']}` is already being watched!")
+                return
+            list_cache.pop(interaction.guild_id, None)
             await interaction.followup.send(f"✅ Subscribed to live notifications for **{channel_info['title']}** on YouTube!")
         else:
             await interaction.followup.send("❌ Failed to create YouTube webhook.")
@@ -273,30 +541,21 @@ async def remove_command(interaction: discord.Interaction, platform: str, identi
     """Handle /remove command to unsubscribe from a streamer."""
     await interaction.response.defer(ephemeral=True)
     
-    guild_subscriptions = db.get_subscriptions_by_guild(interaction.guild_id)
-    target_id = None
     streamer_name = identifier
-
-    if platform == 'twitch':
-        for sub_id, sub_data in guild_subscriptions.items():
-            if sub_data['platform'] == 'twitch' and sub_data['name'].lower() == identifier.lower():
-                target_id = sub_id
-                break
-    elif platform == 'youtube':
-        if identifier in guild_subscriptions:
-            target_id = identifier
-
-    if not target_id:
+    found = db.find_subscription(interaction.guild_id, platform, identifier)
+    if not found:
         await interaction.followup.send(f"❌ No subscription found for `{identifier}` on {platform} in this server.")
         return
     
-    subscription_data = db.get_subscription(target_id)
+    target_id = found[0]
+    subscription_data = db.remove_subscription(target_id)
     if subscription_data:
-        streamer_name = subscription_data['name']
-        if platform == 'twitch' and subscription_data.get('subscription_id'):
-            delete_twitch_subscription(subscription_data['subscription_id'])
+        list_cache.pop(interaction.guild_id, None)
+        twitch_embed_templates.pop(target_id, None)
+        streamer_name = subscription_data.name
+        if platform == 'twitch' and subscription_data.subscription_id:
+            await asyncio.to_thread(delete_twitch_subscription, subscription_data.subscription_id)
         
-        db.remove_subscription(target_id)
         await interaction.followup.send(f"✅ Unsubscribed from **{streamer_name}** on {platform.title()}!")
     else:
         await interaction.followup.send(f"❌ Could not find subscription data for `{identifier}`.")
@@ -306,25 +565,44 @@ async def list_command(interaction: discord.Interaction):
     """Handle /list command to show all subscriptions for this guild."""
     await interaction.response.defer(ephemeral=True)
     
-    guild_subscriptions = db.get_subscriptions_by_guild(interaction.guild_id)
+    cached = list_cache.get(interaction.guild_id)
+    if cached and time.monotonic() - cached[0] < LIST_CACHE_TTL:
+        await interaction.followup.send(embed=cached[1])
+        return
+    
+    twitch_subs, youtube_subs = [], []
+    for _, sub in db.iter_subscriptions_by_guild(interaction.guild_id):
+        (twitch_subs if sub.platform == 'twitch' else youtube_subs).append("• " + sub.name)
     
-    if not guild_subscriptions:
+    if not twitch_subs and not youtube_subs:
         await interaction.followup.send("📋 No active subscriptions in this server.")
         return
     
     embed = discord.Embed(title="📋 Active Stream Subscriptions", color=discord.Color.blue())
     
-    twitch_subs = [f"• {s['name']}" for s in guild_subscriptions.values() if s['platform'] == 'twitch']
-    youtube_subs = [f"• {s['name']}" for s in guild_subscriptions.values() if s['platform'] == 'youtube']
-    
     if twitch_subs:
         embed.add_field(name="🟣 Twitch", value="\n".join(twitch_subs), inline=False)
     
     if youtube_subs:
         embed.add_field(name="🔴 YouTube", value="\n".join(youtube_subs), inline=False)
     
+    list_cache[interaction.guild_id] = (time.monotonic(), embed)
     await interaction.followup.send(embed=embed)
 
+# Fixed parts of the /test embeds, in Embed.to_dict() form
+TWITCH_TEST_EMBED_BASE = {
+    'type': 'rich',
+    'description': "**TEST NOTIFICATION**\n\nGame: Just Chatting\nViewers: 1,234",
+    'color': 0x9146FF,
+    'thumbnail': {'url': "https://static-cdn.jtvnw.net/jtv_user_pictures/default-profile_image-300x300.png"}
+}
+YOUTUBE_TEST_EMBED_BASE = {
+    'type': 'rich',
+    'description': "**TEST NOTIFICATION**\n\nLive on YouTube",
+    'color': 0xFF0000,
+    'thumbnail': {'url': "https://yt3.ggpht.com/default_avatar_300x300.jpg"}
+}
+
 @tree.command(name="test", description="Test stream notifications with a fake stream alert")
 @discord.app_commands.describe(
     platform="Platform to test (twitch or youtube)",
@@ -338,49 +616,34 @@ async def test_command(interaction: discord.Interaction, platform: str, identifi
     """Test stream notification for a subscribed streamer."""
     await interaction.response.defer(ephemeral=True)
     
-    subscription = None
-    streamer_id = None
-
-    for sub_id, sub_data in db.get_subscriptions_by_guild(interaction.guild_id).items():
-        if sub_data['platform'] != platform:
-            continue
-        
-        search_key = sub_data['name'] if platform == 'twitch' else sub_id
-        if search_key.lower() == identifier.lower():
-            subscription = sub_data
-            streamer_id = sub_id
-            break
-
-    if not subscription:
+    found = db.find_subscription(interaction.guild_id, platform, identifier)
+    if not found:
         await interaction.followup.send(f"❌ No subscription found for `{identifier}` on {platform}. Add them first with `/add`!")
         return
+    streamer_id, subscription = found
     
     try:
-        channel = bot.get_channel(subscription['channel_id'])
+        channel = get_cached_channel(subscription.channel_id)
         if not channel:
             await interaction.followup.send(f"❌ Cannot find the notification channel. It may have been deleted.")
             return
         
         if platform == 'twitch':
-            embed = discord.Embed(
-                title=f"🔴 {subscription['name']} is now live!",
-                description=f"**TEST NOTIFICATION**\n\nGame: Just Chatting\nViewers: 1,234",
-                color=0x9146FF,
-                url=f"https://twitch.tv/{subscription['name']}"
-            )
-            embed.set_thumbnail(url="https://static-cdn.jtvnw.net/jtv_user_pictures/default-profile_image-300x300.png")
+            embed = discord.Embed.from_dict({
+                **TWITCH_TEST_EMBED_BASE,
+                'title': f"🔴 {subscription.name} is now live!",
+                'url': f"https://twitch.tv/{subscription.name}"
+            })
         else:
-            embed = discord.Embed(
-                title=f"🔴 {subscription['name']} is streaming!",
-                description=f"**TEST NOTIFICATION**\n\nLive on YouTube",
-                color=0xFF0000,
-                url=f"https://youtube.com/channel/{streamer_id}"
-            )
-            embed.set_thumbnail(url="https://yt3.ggpht.com/default_avatar_300x300.jpg")
+            embed = discord.Embed.from_dict({
+                **YOUTUBE_TEST_EMBED_BASE,
+                'title': f"🔴 {subscription.name} is streaming!",
+                'url': f"https://youtube.com/channel/{streamer_id}"
+            })
         
-        custom_message = subscription.get('custom_message', "")
+        custom_message = subscription.custom_message
         await channel.send(content=custom_message, embed=embed)
-        await interaction.followup.send(f"✅ Test notification sent to {channel.mention} for `{subscription['name']}`!")
+        await interaction.followup.send(f"✅ Test notification sent to {channel.mention} for `{subscription.name}`!")
         
     except Exception as e:
         await interaction.followup.send(f"❌ Error sending test notification: {str(e)}")
@@ -407,14 +670,101 @@ def home():
     """Health check endpoint."""
     return "Stream Notification Bot - Webhook Listener is running."
 
+# Static parts of each streamer's live embed (title, link, color, thumbnail, footer) as Embed.to_dict()
+# output, keyed by Twitch user ID and stored with the display name they were built for; dropped by /remove
+twitch_embed_templates: Dict[str, Tuple[str, Dict]] = {}
+
+def get_twitch_embed_template(user_id: str, username: str, subscription: Subscription) -> Dict:
+    """Return the cached embed skeleton for a streamer, rebuilding it when their display name changes."""
+    cached = twitch_embed_templates.get(user_id)
+    if cached is not None and cached[0] == username:
+        return cached[1]
+    stream_url = subscription.stream_url or f"https://twitch.tv/{username}"
+    embed = discord.Embed(title=f"{username} is now LIVE on Twitch!", url=stream_url, color=discord.Color.purple())
+    embed.set_thumbnail(url=subscription.thumbnail_url or twitch_thumbnail_url(user_id))
+    embed.set_footer(text="Click the title to watch the stream!")
+    template = embed.to_dict()
+    twitch_embed_templates[user_id] = (username, template)
+    return template
+
+def process_twitch_notification(event: Dict, subscription: Subscription) -> None:
+    """Fetch stream details and send the Twitch live notification (runs on WEBHOOK_EXECUTOR)."""
+    user_id = event['broadcaster_user_id']
+    stream_details_url = f"https://api.twitch.tv/helix/streams?user_id={user_id}"
+    game_name, stream_title = "No Category", "Stream is Live!"
+    
+    if config.INCLUDE_STREAM_DETAILS:
+        try:
+            stream_response = twitch_request('GET', stream_details_url, timeout=config.STREAM_DETAILS_TIMEOUT)
+            stream_response.raise_for_status()
+            stream_data = json_loads(stream_response.content).get('data', [])
+            if stream_data:
+                stream_info = stream_data[0]
+                game_name = stream_info.get('game_name', 'No Category')
+                stream_title = stream_info.get('title', 'No Title')
+        except requests.Timeout:
+            print(f"Timed out fetching stream details for {user_id}; sending a basic notification")
+        except Exception as e:
+            print(f"Could not fetch stream details for {user_id}: {e}")
+
+    discord_channel = get_cached_channel(subscription.channel_id)
+    if discord_channel and hasattr(discord_channel, 'send'):
+        custom_msg = subscription.custom_message
+        embed = discord.Embed.from_dict(get_twitch_embed_template(user_id, event['broadcaster_user_name'], subscription))
+        embed.description = f"**{stream_title}**\nPlaying: **{game_name}**\n\n[Click here to watch!]({embed.url})"
+        asyncio.run_coroutine_threadsafe(queue_notification(discord_channel, custom_msg, embed), bot.loop)
+
+# --- TWITCH WEBHOOK REPLAY PROTECTION ---
+
+# Twitch redelivers a message until it is acknowledged; anything older than this is treated as a replay
+TWITCH_MESSAGE_MAX_AGE = 10 * 60
+# Recently handled notification message IDs, oldest first
+SEEN_MESSAGE_IDS_SIZE = 4096
+seen_message_ids: OrderedDict = OrderedDict()
+seen_message_ids_lock = threading.Lock()
+
+def twitch_message_age(message_timestamp: str) -> Optional[float]:
+    """Seconds since an EventSub message timestamp was issued, or None if it can't be parsed."""
+    # RFC 3339 with up to nanosecond precision, which strptime can't take; whole seconds are enough here.
+    try:
+        sent_at = datetime.strptime(message_timestamp[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+    return time.time() - sent_at.timestamp()
+
+def mark_message_seen(message_id: str) -> bool:
+    """Record a notification message ID, returning False if it was already handled."""
+    with seen_message_ids_lock:
+        if message_id in seen_message_ids:
+            return False
+        seen_message_ids[message_id] = None
+        if len(seen_message_ids) > SEEN_MESSAGE_IDS_SIZE:
+            seen_message_ids.popitem(last=False)
+        return True
+
 @app.route('/webhooks/twitch', methods=['POST'])
 def twitch_webhook():
     """Handle Twitch webhook notifications."""
     message_id = request.headers.get('Twitch-Eventsub-Message-Id', '')
     message_timestamp = request.headers.get('Twitch-Eventsub-Message-Timestamp', '')
     message_signature = request.headers.get('Twitch-Eventsub-Message-Signature', '')
-    hmac_message = message_id.encode('utf-8') + message_timestamp.encode('utf-8') + request.data
-    expected_signature = 'sha256=' + hmac.new(WEBHOOK_SECRET.encode('utf-8'), hmac_message, hashlib.sha256).hexdigest()
+
+    # Reject malformed or stale requests before hashing the body.
+    # A valid signature is 'sha256=' followed by 64 hex digits; anything else cannot match.
+    if not message_id or len(message_signature) != 71 or not message_signature.startswith('sha256='):
+        print("Twitch signature mismatch!")
+        abort(403)
+
+    message_age = twitch_message_age(message_timestamp)
+    if message_age is None or message_age > TWITCH_MESSAGE_MAX_AGE:
+        print(f"Rejecting stale Twitch message {message_id}")
+        abort(403)
+
+    mac = WEBHOOK_HMAC_TEMPLATE.copy()
+    mac.update(message_id.encode('utf-8'))
+    mac.update(message_timestamp.encode('utf-8'))
+    mac.update(request.data)
+    expected_signature = 'sha256=' + mac.hexdigest()
 
     if not hmac.compare_digest(expected_signature, message_signature):
         print("Twitch signature mismatch!")
@@ -423,52 +773,117 @@ def twitch_webhook():
     message_type = request.headers.get('Twitch-Eventsub-Message-Type')
     
     if message_type == 'webhook_callback_verification':
-        json_data = request.get_json()
+        json_data = json_loads(request.data)
         if json_data and 'challenge' in json_data:
             return json_data['challenge'], 200
         return 'OK', 200
 
     elif message_type == 'notification':
-        event = request.get_json().get('event', {})
+        # Only stream.online is subscribed to; ignore anything else without reading the body.
+        if request.headers.get('Twitch-Eventsub-Subscription-Type') != 'stream.online':
+            return 'OK', 200
+        # Redeliveries of a notification we already handled are acknowledged without doing it twice.
+        if not mark_message_seen(message_id):
+            return 'OK', 200
+        
+        event = json_loads(request.data).get('event', {})
         user_id = event.get('broadcaster_user_id')
         
         if not user_id: return 'OK', 200
         
         subscription = db.get_subscription(user_id)
-        if subscription and subscription['platform'] == 'twitch':
-            stream_details_url = f"https://api.twitch.tv/helix/streams?user_id={user_id}"
-            headers = {'Client-ID': TWITCH_CLIENT_ID, 'Authorization': f'Bearer {TWITCH_ACCESS_TOKEN}'}
-            game_name, stream_title = "No Category", "Stream is Live!"
-            
-            try:
-                stream_response = requests.get(stream_details_url, headers=headers)
-                stream_response.raise_for_status()
-                stream_data = stream_response.json().get('data', [])
-                if stream_data:
-                    stream_info = stream_data[0]
-                    game_name = stream_info.get('game_name', 'No Category')
-                    stream_title = stream_info.get('title', 'No Title')
-            except Exception as e:
-                print(f"Could not fetch stream details for {user_id}: {e}")
-
-            discord_channel = bot.get_channel(subscription['channel_id'])
-            if discord_channel and hasattr(discord_channel, 'send'):
-                username = event['broadcaster_user_name']
-                custom_msg = subscription.get('custom_message', "")
-                stream_url = f"https://twitch.tv/{username}"
-                embed = discord.Embed(
-                    title=f"{username} is now LIVE on Twitch!",
-                    description=f"**{stream_title}**\nPlaying: **{game_name}**\n\n[Click here to watch!]({stream_url})",
-                    url=stream_url, color=discord.Color.purple()
-                )
-                embed.set_thumbnail(url=f"https://static-cdn.jtvnw.net/jtv_user_pictures/{user_id}-profile_image-300x300.png")
-                embed.set_footer(text="Click the title to watch the stream!")
-                bot.loop.create_task(discord_channel.send(content=custom_msg, embed=embed))
+        if subscription and subscription.platform == 'twitch':
+            WEBHOOK_EXECUTOR.submit(process_twitch_notification, event, subscription)
         return 'OK', 200
 
     return 'OK', 200
 
-# In main.py, replace the entire youtube_webhook function with this one:
+# XML namespaces used in YouTube's PubSubHubbub Atom notifications
+YOUTUBE_FEED_NS = {
+    'atom': 'http://www.w3.org/2005/Atom',
+    'yt': 'http://www.youtube.com/xml/schemas/2015'
+}
+
+# Pulls the channel ID out of a raw notification body without parsing the XML
+YOUTUBE_CHANNEL_ID_RE = re.compile(rb'<yt:channelId>([^<]+)</yt:channelId>')
+
+def process_youtube_notification(body: bytes, subscription: Subscription) -> None:
+    """Parse a YouTube feed notification and send the Discord announcement (runs on WEBHOOK_EXECUTOR)."""
+    try:
+        root = etree.fromstring(body)
+        entry = root.find('atom:entry', YOUTUBE_FEED_NS)
+        if entry is None:
+            return
+        
+        video_id = entry.findtext('yt:videoId', namespaces=YOUTUBE_FEED_NS)
+        
+        if not video_id:
+            return
+    except Exception as e:
+        print(f"Error parsing potential YouTube webhook, ignoring: {e}")
+        return
+    
+    # If parsing was successful, send the right notification.
+    discord_channel = get_cached_channel(subscription.channel_id)
+    if discord_channel and hasattr(discord_channel, 'send'):
+        
+        # --- START OF THE NEW LOGIC ---
+        
+        # These variables are needed for both types of announcements
+        channel_name = subscription.name
+        video_title = entry.findtext('atom:title', 'New Video', YOUTUBE_FEED_NS)
+        custom_msg = subscription.custom_message
+        stream_url = f"https://www.youtube.com/watch?v={video_id}"
+
+        # Check if the notification is for a live stream or a regular video upload.
+        live_status = entry.findtext('yt:liveBroadcastContent', 'none', YOUTUBE_FEED_NS).lower()
+
+        if live_status == 'live':
+            # It's a live stream! Create the "LIVE" embed.
+            embed = discord.Embed(
+                title=f"🔴 {channel_name} is now LIVE on YouTube!",
+                description=f"{video_title}\n\n[Click here to watch!]({stream_url})",
+                url=stream_url, 
+                color=discord.Color.red() # Bright red for live
+            )
+            embed.set_footer(text="Click the title to watch the stream!")
+        else:
+            # It's a regular video upload. Create the "New Video" embed.
+            embed = discord.Embed(
+                title=f"🎬 New Video from {channel_name}!",
+                description=f"{video_title}\n\n[Click here to watch!]({stream_url})",
+                url=stream_url,
+                color=discord.Color.blue() # A different color to distinguish it
+            )
+            embed.set_footer(text="Click the title to watch the video!")
+        
+        embed.set_thumbnail(url=f"https://i.ytimg.com/vi/{video_id}/maxresdefault.jpg")
+        
+        # Send the prepared embed. This one line sends either the live or video notification.
+        asyncio.run_coroutine_threadsafe(queue_notification(discord_channel, custom_msg, embed), bot.loop)
+        
+        # --- END OF THE NEW LOGIC ---
+
+def record_youtube_lease(topic_url: str, lease_seconds: Optional[str], verify_token: Optional[str]) -> None:
+    """Store when a feed's lease runs out, using the lease the hub granted on verification.
+    
+    Only a verification carrying the token of an outstanding subscribe request counts, and each token
+    is accepted once. Anything else leaves the stored expiry alone.
+    """
+    channel_id = parse_qs(urlsplit(topic_url).query).get('channel_id', [None])[0]
+    with youtube_lease_lock:
+        expected = youtube_verify_tokens.get(channel_id) if channel_id else None
+        if expected is None or not hmac.compare_digest(expected, verify_token or ''):
+            return
+        del youtube_verify_tokens[channel_id]
+        try:
+            # Never count on a lease longer than the one we asked for.
+            lease = min(int(lease_seconds), YOUTUBE_LEASE_SECONDS)
+        except (TypeError, ValueError):
+            return
+        expiry = time.time() + lease
+        if db.update_subscription(channel_id, lease_expiry=expiry) is None:
+            youtube_granted_leases[channel_id] = expiry
 
 @app.route('/webhooks/youtube', methods=['GET', 'POST'])
 def youtube_webhook():
@@ -476,66 +891,23 @@ def youtube_webhook():
     if request.method == 'GET':  # Handle verification
         challenge = request.args.get('hub.challenge')
         if challenge:
+            if request.args.get('hub.mode') == 'subscribe':
+                record_youtube_lease(request.args.get('hub.topic', ''), request.args.get('hub.lease_seconds'),
+                                     request.args.get('hub.verify_token'))
             return Response(challenge, mimetype='text/plain')
         return 'OK', 200
 
     elif request.method == 'POST':  # Handle notification
-        try:
-            xml_data = xmltodict.parse(request.data)
-            entry = xml_data.get('feed', {}).get('entry', {})
-            
-            video_id = entry.get('yt:videoId')
-            channel_id = entry.get('yt:channelId')
-            
-            if not video_id or not channel_id:
-                return 'OK', 200
-        except Exception as e:
-            print(f"Error parsing potential YouTube webhook, ignoring: {e}")
+        # Look the channel up before parsing, so pings for channels we don't watch cost one regex scan.
+        match = YOUTUBE_CHANNEL_ID_RE.search(request.data)
+        if not match:
+            return 'OK', 200
+        subscription = db.get_subscription(match.group(1).decode('utf-8', 'replace'))
+        if not subscription or subscription.platform != 'youtube':
             return 'OK', 200
         
-        # If parsing was successful, proceed to check the subscription and send the right notification.
-        subscription = db.get_subscription(channel_id)
-        if subscription and subscription['platform'] == 'youtube':
-            discord_channel = bot.get_channel(subscription['channel_id'])
-            if discord_channel and hasattr(discord_channel, 'send'):
-                
-                # --- START OF THE NEW LOGIC ---
-                
-                # These variables are needed for both types of announcements
-                channel_name = subscription['name']
-                video_title = entry.get('title', 'New Video')
-                custom_msg = subscription.get('custom_message', "")
-                stream_url = f"https://www.youtube.com/watch?v={video_id}"
-
-                # Check if the notification is for a live stream or a regular video upload.
-                live_status = entry.get('yt:liveBroadcastContent', 'none').lower()
-
-                if live_status == 'live':
-                    # It's a live stream! Create the "LIVE" embed.
-                    embed = discord.Embed(
-                        title=f"🔴 {channel_name} is now LIVE on YouTube!",
-                        description=f"{video_title}\n\n[Click here to watch!]({stream_url})",
-                        url=stream_url, 
-                        color=discord.Color.red() # Bright red for live
-                    )
-                    embed.set_footer(text="Click the title to watch the stream!")
-                else:
-                    # It's a regular video upload. Create the "New Video" embed.
-                    embed = discord.Embed(
-                        title=f"🎬 New Video from {channel_name}!",
-                        description=f"{video_title}\n\n[Click here to watch!]({stream_url})",
-                        url=stream_url,
-                        color=discord.Color.blue() # A different color to distinguish it
-                    )
-                    embed.set_footer(text="Click the title to watch the video!")
-                
-                embed.set_thumbnail(url=f"https://i.ytimg.com/vi/{video_id}/maxresdefault.jpg")
-                
-                # Send the prepared embed. This one line sends either the live or video notification.
-                bot.loop.create_task(discord_channel.send(content=custom_msg, embed=embed))
-                
-                # --- END OF THE NEW LOGIC ---
-
+        # Acknowledge right away; parsing and the Discord send happen off the request thread.
+        WEBHOOK_EXECUTOR.submit(process_youtube_notification, request.data, subscription)
         return 'OK', 200
     
     return 'OK', 200
@@ -543,14 +915,15 @@ def youtube_webhook():
 # --- RUNNING THE BOT AND SERVER ---
 
 def run_flask():
-    """Run Flask webhook server."""
-    app.run(host=FLASK_HOST, port=FLASK_PORT, debug=False)
+    """Run the Flask webhook app on a waitress thread pool."""
+    serve(app, host=config.FLASK_HOST, port=config.FLASK_PORT, threads=16, connection_limit=512)
 
 def run_bot():
     """Run Discord bot."""
-    bot.run(DISCORD_TOKEN)
+    bot.run(config.DISCORD_TOKEN)
 
 if __name__ == '__main__':
+    config.validate()
     print("Starting Stream Notification Bot...")
     
     get_twitch_app_access_token()
@@ -559,6 +932,7 @@ if __name__ == '__main__':
     flask_thread.daemon = True
     flask_thread.start()
     
-    print(f"Flask webhook server started on {FLASK_HOST}:{FLASK_PORT}")
+    print(f"Flask webhook server started on {config.FLASK_HOST}:{config.FLASK_PORT}")
     
     run_bot()
+    db.flush()